@@ -1,5 +1,9 @@
-import os, hmac, hashlib, base64, json, requests, re
+import os, hmac, hashlib, base64, requests, re, queue, threading, functools
+import orjson
+from collections import OrderedDict
 from flask import Flask, request
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from sudachipy import dictionary, tokenizer as sudachi_tokenizer
 
 # ========= 環境変数 =========
@@ -9,19 +13,53 @@ DEEPL_API_KEY = os.environ["DEEPL_API_KEY"]
 
 app = Flask(__name__)
 
+# ========= HTTP セッション（接続を使い回す）=========
+def _make_session(base_url: str) -> requests.Session:
+    # 接続失敗と 429/5xx だけ再試行する。読み取りタイムアウトは DeepL 側で処理済みかもしれないので
+    # 再送しない（read=0）。Retry-After には従わず、ワーカーを長く止めない
+    retry = Retry(total=3, read=0, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=frozenset({"POST"}), raise_on_status=False,
+                  respect_retry_after_header=False)
+    s = requests.Session()
+    s.mount(base_url, HTTPAdapter(pool_connections=8, pool_maxsize=32, max_retries=retry))
+    return s
+
+_DEEPL_SESSION = _make_session("https://api-free.deepl.com")
+# LINE のトークンは LINE 用セッションにだけ載せる
+_LINE_SESSION = _make_session("https://api.line.me")
+_LINE_SESSION.headers.update({"Content-Type": "application/json",
+                              "Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}"})
+
 # ========= 署名検証 =========
+# 鍵の ipad/opad 処理は起動時に一度だけ済ませ、リクエストごとに copy() して使う
+_HMAC_BASE = hmac.new(LINE_CHANNEL_SECRET.encode("utf-8"), digestmod=hashlib.sha256)
+
 def verify_signature(body: bytes, signature: str) -> bool:
-    mac = hmac.new(LINE_CHANNEL_SECRET.encode("utf-8"), body, hashlib.sha256).digest()
-    expected = base64.b64encode(mac).decode("utf-8")
-    return hmac.compare_digest(expected, signature or "")
+    # 受け取った署名を一度だけデコードして、生の 32 バイト同士を比べる
+    try:
+        sig = base64.b64decode(signature or "", validate=True)
+    except ValueError:
+        return False
+    mac = _HMAC_BASE.copy()
+    mac.update(body)
+    return hmac.compare_digest(mac.digest(), sig)
 
 # ========= DeepL 翻訳 =========
-def deepl_translate(text: str, target_lang: str) -> str:
+# 同じ文（あいさつ・定型文）は DeepL を呼ばずにプロセス内キャッシュから返す
+@functools.lru_cache(maxsize=10000)
+def _deepl_translate_cached(text: str, target_lang: str) -> str:
     url = "https://api-free.deepl.com/v2/translate"
     data = {"auth_key": DEEPL_API_KEY, "text": text, "target_lang": target_lang}
-    r = requests.post(url, data=data, timeout=15)
+    r = _DEEPL_SESSION.post(url, data=data, timeout=15)
     r.raise_for_status()
-    return r.json()["translations"][0]["text"]
+    return orjson.loads(r.content)["translations"][0]["text"]
+
+def deepl_translate(text: str, target_lang: str) -> str:
+    # 前後の空白だけが違う文も同じキャッシュに当てる。空なら DeepL を呼ばない
+    text = text.strip()
+    if not text:
+        return text
+    return _deepl_translate_cached(text, target_lang)
 
 # ========= 言語判定 =========
 VI_CHARS = set(
@@ -35,8 +73,16 @@ VI_CHARS = set(
     "ùúủũụưừứửữự"
     "ỳýỷỹỵ"
 )
-def guess_and_translate(text: str):
-    is_vi = any(c in VI_CHARS for c in text)
+VI_RE = re.compile("[" + re.escape("".join(sorted(VI_CHARS))) + "]")
+
+# 文字（かな・漢字・ラテン文字など）を 1 つも含まない入力（絵文字・数字・記号だけ）は翻訳しない
+_HAS_LETTER_RE = re.compile(r"[^\W\d_]")
+
+def guess_and_translate(text: str) -> tuple:
+    if not _HAS_LETTER_RE.search(text):
+        return None, text
+    # ASCII だけの文字列は走査せずに JA 扱い（str.isascii は O(1)）
+    is_vi = (not text.isascii()) and VI_RE.search(text) is not None
     if is_vi:
         return "VI", deepl_translate(text, "JA")
     else:
@@ -60,116 +106,164 @@ def _four_digits_to_kanji(n: int) -> str:
         s += ("" if (u and d == 1) else _DIG[d]) + u
     return s or _DIG[0]
 
+# 0〜9999 は 1 万通りしかないので起動時に全部作っておく
+_FOUR_DIGITS_KANJI = tuple(_four_digits_to_kanji(n) for n in range(10000))
+
 def num_to_kanji(num: int) -> str:
     if num == 0: return _DIG[0]
+    # 価格はほぼ 1 億未満なので、表を 1〜2 回引くだけで済ませる
+    if num < 10000: return _FOUR_DIGITS_KANJI[num]
+    if num < 100000000:
+        man, rest = divmod(num, 10000)
+        return _FOUR_DIGITS_KANJI[man] + _UNIT4[1] + (_FOUR_DIGITS_KANJI[rest] if rest else "")
     parts = []; i = 0
     while num > 0 and i < len(_UNIT4):
         n = num % 10000
-        if n: parts.append(_four_digits_to_kanji(n) + _UNIT4[i])
+        if n: parts.append(_FOUR_DIGITS_KANJI[n] + _UNIT4[i])
         num //= 10000; i += 1
         if i > 6: break
     return "".join(reversed(parts)) or _DIG[0]
 
-_price_patterns = [
-    re.compile(r"(¥)\s*(\d{1,3}(?:,\d{3})+|\d+)"),
-    re.compile(r"(\d{1,3}(?:,\d{3})+|\d+)\s*円"),
-    re.compile(r"(?:VND|vnd)\s*(\d{1,3}(?:[.,]\d{3})+|\d+)"),
-    re.compile(r"(\d{1,3}(?:[.,]\d{3})+|\d+)\s*(?:VND|vnd)"),
-    re.compile(r"[₫đ]\s*(\d{1,3}(?:[.,]\d{3})+|\d+)"),
-    re.compile(r"(\d{1,3}(?:[.,]\d{3})+|\d+)\s*[₫đ]"),
-]
+# 6 種類の価格表記を 1 本の正規表現にまとめて 1 パスで置換する（どの分岐に当たったかは lastgroup で判定）
+_YEN_NUM = r"\d{1,3}(?:,\d{3})+|\d+"
+_VND_NUM = r"\d{1,3}(?:[.,]\d{3})+|\d+"
+_PRICE_RE = re.compile(
+    rf"¥\s*(?P<yen_pre>{_YEN_NUM})"
+    rf"|(?P<yen_post>{_YEN_NUM})\s*円"
+    rf"|(?:VND|vnd)\s*(?P<vnd_pre>{_VND_NUM})"
+    rf"|(?P<vnd_post>{_VND_NUM})\s*(?:VND|vnd)"
+    rf"|[₫đ]\s*(?P<dong_pre>{_VND_NUM})"
+    rf"|(?P<dong_post>{_VND_NUM})\s*[₫đ]"
+)
+_PRICE_UNIT = {"yen_pre": "円", "yen_post": "円",
+               "vnd_pre": "ドン", "vnd_post": "ドン", "dong_pre": "ドン", "dong_post": "ドン"}
+
+_NON_DIGIT_RE = re.compile(r"[^\d]")
+
 def _digits_to_int(s: str) -> int:
-    return int(re.sub(r"[^\d]", "", s))
+    return int(_NON_DIGIT_RE.sub("", s))
+
+def _price_to_kanji(m) -> str:
+    return num_to_kanji(_digits_to_int(m.group(m.lastgroup))) + _PRICE_UNIT[m.lastgroup]
+
+_HAS_DIGIT_RE = re.compile(r"\d")
 
 def convert_prices_to_kanji(text: str) -> str:
-    def yen_symbol(m): return f"{num_to_kanji(_digits_to_int(m.group(2)))}円"
-    def yen_after(m):  return f"{num_to_kanji(_digits_to_int(m.group(1)))}円"
-    def vnd_pre(m):    return f"{num_to_kanji(_digits_to_int(m.group(1)))}ドン"
-    def vnd_post(m):   return f"{num_to_kanji(_digits_to_int(m.group(1)))}ドン"
-    text = _price_patterns[0].sub(yen_symbol, text)
-    text = _price_patterns[1].sub(yen_after, text)
-    text = _price_patterns[2].sub(vnd_pre, text)
-    text = _price_patterns[3].sub(vnd_post, text)
-    text = _price_patterns[4].sub(vnd_pre, text)
-    text = _price_patterns[5].sub(vnd_post, text)
-    return text
+    # 数字が無ければ価格もない（あいさつ等の大半はここで終わる）
+    if not _HAS_DIGIT_RE.search(text):
+        return text
+    return _PRICE_RE.sub(_price_to_kanji, text)
 
 def _is_whitespace(s: str) -> bool:
-    return bool(s) and all(ch.isspace() for ch in s)
-
-def _token_to_hira(t) -> str:
-    pos0 = t.part_of_speech()[0]
-    surf = t.surface()
-    if _is_whitespace(surf):    # 空白は捨てる
-        return ""
-    if pos0 in ("記号", "補助記号"):  # 記号はそのまま
-        return surf
-    if re.fullmatch(r"[0-9A-Za-z]+", surf):  # 英数字はそのまま
-        return surf
-    yomi = t.reading_form()
-    return surf if yomi == "*" else yomi.translate(_katakana_to_hira)
+    # 空文字は False、全部空白なら True（str.isspace と同じ意味なので C 実装に任せる）
+    return s.isspace()
 
-def to_hiragana(text: str, spaced: bool = False) -> str:
+_SYMBOL_POS = frozenset(("記号", "補助記号"))
+
+# 読みは同じものが何度も出てくるので、カタカナ→ひらがな変換の結果を覚えておく
+@functools.lru_cache(maxsize=65536)
+def _reading_to_hira(yomi: str) -> str:
+    return yomi.translate(_katakana_to_hira)
+
+# かな・漢字（全角英数・半角カナも読みが変わるので含める）が無ければ Sudachi 不要
+HAS_JP_RE = re.compile(r"[ぁ-ゟァ-ヿ㐀-䶿一-鿿々〆ｦ-ﾟ０-９Ａ-Ｚａ-ｚ]")
+
+@functools.lru_cache(maxsize=4096)
+def _hiragana_chunks(text: str) -> tuple:
     text = convert_prices_to_kanji(text).replace("\u3000", " ")
-    tokens = list(_sudachi.tokenize(text, _SPLIT))
+    if not HAS_JP_RE.search(text):
+        return tuple(text.split())
+    # 1 トークンにつき surface / 品詞 / 読みを 1 回だけ取り出して、先にかなへ変換しておく
+    kanas = []; pos0s = []
+    for t in _sudachi.tokenize(text, _SPLIT):
+        surf = t.surface()
+        if _is_whitespace(surf):  # 空白は捨てる
+            continue
+        pos0 = t.part_of_speech()[0]
+        if pos0 in _SYMBOL_POS or (surf.isascii() and surf.isalnum()):  # 記号・英数字はそのまま
+            kanas.append(surf)
+        else:
+            yomi = t.reading_form()
+            kanas.append(surf if yomi == "*" else _reading_to_hira(yomi))
+        pos0s.append(pos0)
+    # 直後の助動詞を連結（しました／します／した など）
     chunks = []
-    i = 0
-    while i < len(tokens):
-        t = tokens[i]
-        if _is_whitespace(t.surface()):
-            i += 1; continue
-        merged = _token_to_hira(t)
-        j = i + 1
-        # 直後の助動詞を連結（しました／します／した など）
-        while j < len(tokens):
-            tj = tokens[j]
-            if _is_whitespace(tj.surface()):
-                j += 1; continue
-            if tj.part_of_speech()[0] == "助動詞":
-                merged += _token_to_hira(tj); j += 1
-            else:
-                break
-        if merged:
-            chunks.append(merged)
-        i = j
+    merged = None
+    for kana, pos0 in zip(kanas, pos0s):
+        if merged is not None and pos0 == "助動詞":
+            merged += kana
+        else:
+            if merged:
+                chunks.append(merged)
+            merged = kana
+    if merged:
+        chunks.append(merged)
+    return tuple(chunks)
+
+# チャンク自体は空白を含まないので、結合時の空白は 1 個ずつ
+_SPACE_BEFORE_PUNCT_RE = re.compile(r" ([、。！？!?])")
+
+def to_hiragana(text: str, spaced: bool = False) -> str:
+    chunks = _hiragana_chunks(text)
     if spaced:
-        out = " ".join(chunks)
-        out = re.sub(r"\s+", " ", out).strip()
-        out = re.sub(r"\s+([、。！？!?])", r"\1", out)
-        return out
+        return _SPACE_BEFORE_PUNCT_RE.sub(r"\1", " ".join(chunks))
     return "".join(chunks)
 
 # ========= LINE 返信 =========
 def reply_message(reply_token: str, text: str):
-    headers = {"Content-Type": "application/json",
-               "Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}"}
     body = {"replyToken": reply_token, "messages": [{"type": "text", "text": text[:4900]}]}
-    requests.post("https://api.line.me/v2/bot/message/reply",
-                  headers=headers, data=json.dumps(body), timeout=15)
+    r = _LINE_SESSION.post("https://api.line.me/v2/bot/message/reply",
+                           data=orjson.dumps(body), timeout=15)
+    # 応答内容は使わないが、失敗は黙って捨てずにログに残す
+    if not r.ok:
+        app.logger.warning("LINE reply failed: %s %s", r.status_code, r.text[:200])
 
 # ========= 状態管理（ひらがなのみ）=========
-state = {}
+# ワーカースレッドから同時に触るので、chat_id のハッシュで分けたシャードごとにロックする。
+# 各シャードは OrderedDict の LRU で上限を超えたら古いチャットから捨てる。
 DEFAULTS = {"show_hira": True}
+STATE_SHARDS = 16
+STATE_MAX_PER_SHARD = 4096
+_shards = [(OrderedDict(), threading.Lock()) for _ in range(STATE_SHARDS)]
 
-def get_state(chat_id: str):
-    if chat_id not in state:
-        state[chat_id] = DEFAULTS.copy()
-    return state[chat_id]
+def _shard(chat_id: str):
+    return _shards[hash(chat_id) % STATE_SHARDS]
 
-def set_state(chat_id: str, **kwargs):
-    s = get_state(chat_id)
-    for k, v in kwargs.items():
-        if k in s and isinstance(v, bool):
-            s[k] = v
-    state[chat_id] = s
+def _get_locked(shard: OrderedDict, chat_id: str) -> dict:
+    s = shard.get(chat_id)
+    if s is None:
+        s = shard[chat_id] = DEFAULTS.copy()
+        if len(shard) > STATE_MAX_PER_SHARD:
+            shard.popitem(last=False)
+    else:
+        shard.move_to_end(chat_id)
     return s
 
-def parse_command(text: str):
-    t = (text or "").strip().lower()
-    if t == "/status": return ("status", None)
-    m = re.match(r"^/(hira|h)\s+(on|off)$", t)
-    if m: return ("hira", m.group(2) == "on")
-    return (None, None)
+def get_state(chat_id: str) -> dict:
+    shard, lock = _shard(chat_id)
+    with lock:
+        return _get_locked(shard, chat_id)
+
+def set_state(chat_id: str, **kwargs) -> dict:
+    shard, lock = _shard(chat_id)
+    with lock:
+        s = _get_locked(shard, chat_id)
+        for k, v in kwargs.items():
+            if k in s and isinstance(v, bool):
+                s[k] = v
+        return s
+
+# コマンドは 1 本の正規表現で判定し、どの名前付きグループに当たったかで振り分ける
+_CMD_RE = re.compile(r"^/(?:(?P<status>status)|(?:hira|h)\s+(?P<hira>on|off))$")
+
+def parse_command(text: str) -> tuple:
+    t = (text or "").strip()
+    # コマンドは必ず "/" で始まるので、普通のメッセージは lower() せずに抜ける
+    if not t.startswith("/"): return (None, None)
+    m = _CMD_RE.match(t.lower())
+    if not m: return (None, None)
+    if m.group("status"): return ("status", None)
+    return ("hira", m.group("hira") == "on")
 
 # ========= 健康確認 =========
 @app.route("/", methods=["GET"])
@@ -179,6 +273,75 @@ def health():
 # 先頭の [JP→VN] 等を除去
 TAG_PREFIX_RE = re.compile(r'^\[\s*(?:JP|JA|VN|VI)\s*[\-→]\s*(?:JP|JA|VN|VI)\s*\]\s*', re.IGNORECASE)
 
+# ========= イベント処理（ワーカースレッドで実行）=========
+def _chat_id(ev: dict):
+    src = ev.get("source", {})
+    return src.get("groupId") or src.get("roomId") or src.get("userId")
+
+def _process_event(ev: dict):
+    if ev.get("type") != "message":
+        return
+    msg = ev.get("message", {})
+    if msg.get("type") != "text":
+        # 画像や他メディアは無視（OCR 機能は停止）
+        return
+
+    text = msg.get("text") or ""
+    if text.startswith("["):
+        text = TAG_PREFIX_RE.sub("", text, count=1)
+
+    # チャット単位の設定
+    chat_id = _chat_id(ev)
+    s = get_state(chat_id)
+
+    # コマンド
+    cmd, val = parse_command(text)
+    if cmd == "hira":
+        set_state(chat_id, show_hira=val)
+        reply_message(ev["replyToken"], f"Đã {'bật' if val else 'tắt'} hiển thị Hiragana.")
+        return
+    if cmd == "status":
+        reply_message(
+            ev["replyToken"],
+            f"Cài đặt hiện tại\n- Hiragana: {'ON' if s['show_hira'] else 'OFF'}"
+        )
+        return
+
+    # 翻訳
+    src_lang, translated = guess_and_translate(text)
+    if src_lang is None:
+        return
+
+    lines = []
+    if src_lang == "VI":
+        lines.append("[VN→JP]")
+        lines.append(translated)
+        if s["show_hira"]:
+            lines.append(f"\n(hiragana) {to_hiragana(translated, spaced=True)}")
+    else:
+        lines.append("[JP→VN]")
+        lines.append(translated)
+
+    reply_message(ev["replyToken"], "\n".join(lines))
+
+# LINE には即 200 を返し、翻訳・返信はキュー経由でワーカーが処理する。
+# 同じチャットのイベントは常に同じワーカーのキューに入れて、届いた順に 1 件ずつ処理する
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", "4"))
+WORK_QS = [queue.Queue(maxsize=1024) for _ in range(WORKER_THREADS)]
+
+def _worker(q: queue.Queue):
+    while True:
+        ev = q.get()
+        try:
+            _process_event(ev)
+        except Exception:
+            app.logger.exception("failed to process event")
+        finally:
+            q.task_done()
+
+for _q in WORK_QS:
+    threading.Thread(target=_worker, args=(_q,), daemon=True).start()
+
 # ========= Webhook =========
 @app.route("/webhook", methods=["POST"])
 def webhook():
@@ -189,49 +352,15 @@ def webhook():
     if not verify_signature(body, signature):
         return "bad signature", 400
 
-    data = request.get_json(silent=True) or {}
+    try:
+        data = orjson.loads(body) or {}
+    except orjson.JSONDecodeError:
+        data = {}
     for ev in data.get("events", []):
-        if ev.get("type") != "message":
-            continue
-        msg = ev.get("message", {})
-        if msg.get("type") != "text":
-            # 画像や他メディアは無視（OCR 機能は停止）
-            continue
-
-        text = TAG_PREFIX_RE.sub("", msg.get("text") or "", count=1)
-
-        # チャット単位の設定
-        src = ev.get("source", {})
-        chat_id = src.get("groupId") or src.get("roomId") or src.get("userId")
-        s = get_state(chat_id)
-
-        # コマンド
-        cmd, val = parse_command(text)
-        if cmd == "hira":
-            set_state(chat_id, show_hira=val)
-            reply_message(ev["replyToken"], f"Đã {'bật' if val else 'tắt'} hiển thị Hiragana.")
-            continue
-        if cmd == "status":
-            reply_message(
-                ev["replyToken"],
-                f"Cài đặt hiện tại\n- Hiragana: {'ON' if s['show_hira'] else 'OFF'}"
-            )
-            continue
-
-        # 翻訳
-        src_lang, translated = guess_and_translate(text)
-
-        lines = []
-        if src_lang == "VI":
-            lines.append("[VN→JP]")
-            lines.append(translated)
-            if s["show_hira"]:
-                lines.append(f"\n(hiragana) {to_hiragana(translated, spaced=True)}")
-        else:
-            lines.append("[JP→VN]")
-            lines.append(translated)
-
-        reply_message(ev["replyToken"], "\n".join(lines))
+        try:
+            WORK_QS[hash(_chat_id(ev)) % WORKER_THREADS].put_nowait(ev)
+        except queue.Full:
+            app.logger.warning("work queue full, dropping event")
 
     return "OK", 200
 